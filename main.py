@@ -1,7 +1,7 @@
-from flask import Flask, Response, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, render_template, request
 
 from src.audio import QueueAudioHandler
-from src.utils.general import URLRequest, run_in_thread
+from src.utils.general import URLRequest, json_dumps, run_in_thread, shutdown_workers
 import json
 
 WEBHOOK_URL = None
@@ -27,6 +27,8 @@ def send_webhook(func):
             headers={
                 "Content-Type": "application/json",
             },
+            # runs on the worker pool, don't let a dead webhook hold up exit
+            timeout=10,
         )
 
         if res.getcode() != 204:
@@ -52,7 +54,10 @@ def check_empty(arg) -> bool:
     if arg is None:
         return True
 
-    return any(arg) and (len(arg) != 0)
+    arg_type = type(arg)
+    if arg_type is dict or arg_type is list or arg_type is str:
+        return len(arg) != 0
+    return bool(arg)
 
 
 def make_response(
@@ -71,7 +76,12 @@ def make_response(
     if other_data:
         build_resp.update({"other_data": other_data})
 
-    return jsonify(build_resp), status_code
+    return (
+        Response(
+            json_dumps(build_resp), status=status_code, mimetype="application/json"
+        ),
+        status_code,
+    )
 
 
 def make_error(*args, **kwargs):
@@ -80,9 +90,11 @@ def make_error(*args, **kwargs):
 
 def gen(audio: QueueAudioHandler):
     yield audio.wait_for_header()
+    # start from the current page rather than replaying the whole backlog
+    seq = max(audio.buffer_seq - 1, 0)
     while audio.audio_thread.is_alive():
-        yield audio.buffer
-        audio.event.wait()
+        seq, buffer = audio.wait_for_buffer(seq)
+        yield buffer
     return
 
 
@@ -99,11 +111,11 @@ def check_args(args_name: list):
             else:
                 return abort(500)
 
-            for arg in args_name:
-                if arg not in data:
-                    return abort(500)
-                else:
-                    kwargs[arg] = data.get(arg)
+            try:
+                for arg in args_name:
+                    kwargs[arg] = data[arg]
+            except KeyError:
+                return abort(500)
             return func(*args, **kwargs)
 
         wrapper.__name__ = func.__name__
@@ -140,15 +152,19 @@ def get_queue():
     index = int(request.args.get("index") or request.args.get("page", 0)) + 1
     use_autoqueue = request.args.get("use_autoqueue", "0") == "1"
 
-    end_offset = max(index * 5, len(audio.queue))
+    # take a lock-free snapshot; it may miss an item appended concurrently,
+    # which is fine for a UI listing.
+    queue = list(audio.queue)
+    end_offset = max(index * 5, len(queue))
     start_offset = max(end_offset - 5, 0)
 
     data = {
-        "queue": audio.queue[start_offset:end_offset],
+        "queue": queue[start_offset:end_offset],
     }
 
-    if use_autoqueue and audio.auto_queue:
-        data.update({"auto_queue": audio.auto_queue})
+    auto_queue = list(audio.auto_queue)
+    if use_autoqueue and auto_queue:
+        data.update({"auto_queue": auto_queue})
 
     return make_response(data=data)
 
@@ -158,15 +174,16 @@ def get_queue():
 def get_nowplaying():
     data: dict = {"now_playing": audio.now_playing}
 
-    if audio.queue:
-        data.update({"next_up": audio.queue[0]})
+    queue = list(audio.queue)
+    if queue:
+        data.update({"next_up": queue[0]})
 
     return make_response(data=data)
 
 
 @app.route("/skip", methods=["POST"])
 def skip():
-    audio._skip = True
+    audio.skip()
     return make_response()
 
 
@@ -180,7 +197,9 @@ def get_stream():
 
 @app.route("/")
 def index():
-    return render_template("stream.html", np=audio.now_playing, queue=audio.queue)
+    return render_template(
+        "stream.html", np=audio.now_playing, queue=list(audio.queue)
+    )
 
 
 @app.route("/watch_event")
@@ -189,4 +208,7 @@ def watch_event():
 
 
 if __name__ == "__main__":
-    app.run("0.0.0.0", port=5000, threaded=True)
+    try:
+        app.run("0.0.0.0", port=5000, threaded=True)
+    finally:
+        shutdown_workers()
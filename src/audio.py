@@ -1,19 +1,99 @@
+import os
+import selectors
 import sys
-import json
 import subprocess
-from array import array
-from queue import Queue
+from collections import deque
+from queue import Queue, SimpleQueue
 from random import randint
-from threading import Event, Lock, Thread
-from time import sleep
-from typing import Any, Generator, Union
+from threading import Condition, Event, Lock, Thread
+from typing import Generator, Union
 
 from src.utils import extractor
-from src.utils.general import MISSING_TYPE, URLRequest, run_in_thread
+from src.utils.general import MISSING_TYPE, URLRequest, json_dumps, run_in_thread
 from src.utils.opusreader import OggStream
 
 MISSING = MISSING_TYPE()
 
+# one pipe's worth, larger writes go straight through the stdin BufferedWriter
+_PIPE_CHUNK_SIZE = 1 << 16
+
+# pages kept for listeners that lag behind the reader
+_PAGE_BACKLOG = 50
+
+# pipe to pipe inside the kernel, linux only
+_USE_SPLICE = hasattr(os, "splice")
+# select() only takes sockets on windows, there the pump sees a skip between
+# reads instead of being woken up by the skip pipe
+_USE_SKIP_PIPE = os.name == "posix"
+
+_MAIN_FFMPEG_CMD = (
+    "ffmpeg",
+    "-re",
+    "-i",
+    "-",
+    "-threads",
+    "2",
+    "-c:a",
+    "copy",
+    "-f",
+    "opus",
+    "-loglevel",
+    "error",
+    "pipe:1",
+)
+# the track url goes between the input options and one of the output options
+_TRACK_FFMPEG_INPUT = (
+    "ffmpeg",
+    "-reconnect",
+    "1",
+    "-reconnect_streamed",
+    "1",
+    "-reconnect_delay_max",
+    "5",
+    # start emitting as soon as possible instead of probing seconds of input
+    "-fflags",
+    "nobuffer",
+    "-flags",
+    "low_delay",
+    "-probesize",
+    "32k",
+    "-analyzeduration",
+    "0",
+    "-i",
+)
+_TRACK_FFMPEG_COPY = (
+    "-threads",
+    "2",
+    "-c:a",
+    "copy",
+    "-f",
+    "opus",
+    "-vn",
+    "-flush_packets",
+    "1",
+    "-loglevel",
+    "error",
+    "pipe:1",
+)
+_TRACK_FFMPEG_REENCODE = (
+    "-threads",
+    "2",
+    "-c:a",
+    "libopus",
+    "-b:a",
+    "152k",
+    "-ar",
+    "48000",
+    "-f",
+    "opus",
+    "-vn",
+    "-flush_packets",
+    "1",
+    "-loglevel",
+    "error",
+    "pipe:1",
+)
+
 
 def get_or_set_savefile(data=None):
     patf = sys.path[0] + "/.saveurl"
@@ -33,45 +113,57 @@ class SendEvent:
     NOW_PLAYING = "nowplaying"
 
     def __init__(self) -> None:
-        self.event_queue = Queue()
-        self.event_data = ""
-        self.event_signal = Event()
+        # replayed to clients that connect mid-track
+        self.last_nowplaying: bytes | None = None
 
-        self._event = Thread(
-            target=self.manage_event, name="send_event_manager", daemon=True
-        )
-        self._event.start()
+        # copy-on-write: watchers swap in a new tuple, add_event only reads
+        # the current one.
+        self._users: tuple[SimpleQueue, ...] = ()
+        self._users_lock = Lock()
 
-    def watch(self) -> Generator[str, None, None]:
-        if "nowplaying" in self.event_data:
-            yield self.event_data
+    def watch(self) -> Generator[bytes, None, None]:
+        user_queue = SimpleQueue()
+        with self._users_lock:
+            self._users = self._users + (user_queue,)
 
-        while True:
-            self.event_signal.wait()
-            yield self.event_data
+        try:
+            if self.last_nowplaying is not None:
+                yield self.last_nowplaying
 
-    def manage_event(self):
-        while True:
-            self.event_signal.clear()
-            data: tuple[str, dict[str, Any]] = self.event_queue.get()
-            self.event_data = f"event: {data[0]}\ndata: {json.dumps(data[1])}\n\n"
-            self.event_signal.set()
+            while True:
+                yield user_queue.get()
+        finally:
+            with self._users_lock:
+                self._users = tuple(q for q in self._users if q is not user_queue)
 
     def add_event(self, event_type: str, data: dict):
-        self.event_queue.put((event_type, data))
+        # built once on the caller's thread and shared by every client
+        frame = b"".join(
+            (b"event: ", event_type.encode(), b"\ndata: ", json_dumps(data), b"\n\n")
+        )
+        if event_type == self.NOW_PLAYING:
+            self.last_nowplaying = frame
+
+        for user_queue in self._users:
+            user_queue.put_nowait(frame)
 
 
 class QueueAudioHandler:
     __slots__ = (
         "queue",
         "auto_queue",
+        "autoqueue_refilling",
         "_skip",
-        "lock",
-        "event",
+        "_skip_pipe",
+        "buffer_cond",
+        "buffer_seq",
         "now_playing",
         "header",
-        "buffer",
-        "next_signal",
+        "header_ready",
+        "pages",
+        "track_cond",
+        "track_done",
+        "queue_signal",
         "ffmpeg",
         "ffmpeg_stdout",
         "ffmpeg_stdin",
@@ -83,20 +175,35 @@ class QueueAudioHandler:
 
     def __init__(self):
         # self.queue = ["https://music.youtube.com/watch?v=cUuQ5L6Obu4"]
-        self.queue: list[Union[str, dict[str, str | bool | float]]] = [
-            get_or_set_savefile()
-        ]
-        self.auto_queue: list[Union[str, dict[str, str | bool | float]]] = []
+        self.queue: deque[Union[str, dict[str, str | bool | float]]] = deque(
+            [get_or_set_savefile()]
+        )
+        self.auto_queue: deque[Union[str, dict[str, str | bool | float]]] = deque()
+        self.autoqueue_refilling = False
 
         self._skip = False
-        self.lock = Lock()
-        self.event = Event()
+        # self-pipe that wakes the pump's selector on skip
+        self._skip_pipe = None
+        if _USE_SKIP_PIPE:
+            self._skip_pipe = os.pipe()
+            os.set_blocking(self._skip_pipe[0], False)
+            os.set_blocking(self._skip_pipe[1], False)
         self.now_playing: dict = {}
 
         self.header = b""
-        self.buffer = b""
-
-        self.next_signal = Event()
+        self.header_ready = Event()
+        # the most recent pages, listeners that fall behind catch up from here
+        self.pages: deque[bytes] = deque(maxlen=_PAGE_BACKLOG)
+        # bumped for every published page so listeners never miss an edge
+        self.buffer_cond = Condition()
+        self.buffer_seq = 0
+
+        # counts finished tracks, the writer bumps it and the queue handler
+        # waits until it moves past the track it handed over
+        self.track_cond = Condition()
+        self.track_done = 0
+        # set whenever a track is added so an idle queue handler wakes up
+        self.queue_signal = Event()
 
         self.event_queue = SendEvent()
 
@@ -126,17 +233,33 @@ class QueueAudioHandler:
 
     @audio_position.setter
     def audio_position(self, value):
-        with self.lock:
-            self._audio_position = value
+        # a single attribute store, already atomic
+        self._audio_position = value
 
     def populate_autoqueue(self):
-        if not self.auto_queue and not self.queue:
-            # take 2 items only
-            self.auto_queue = extractor.youtube_get_related_tracks(self.now_playing)[:2]
+        try:
+            if not self.auto_queue and not self.queue:
+                # take 2 items only
+                self.auto_queue.extend(
+                    extractor.youtube_get_related_tracks(self.now_playing)[:2]
+                )
+                if self.auto_queue:
+                    self.queue_signal.set()
+        finally:
+            self.autoqueue_refilling = False
+
+    def prefetch_autoqueue(self):
+        # only the queue handler schedules this, so the flag needs no lock
+        if self.autoqueue_refilling:
+            return
+
+        self.autoqueue_refilling = True
+        run_in_thread(self.populate_autoqueue, wait_for_result=False)
 
     def add(self, url):
         ret = extractor.create(url, process=False)
         self.queue.append(ret)
+        self.queue_signal.set()
         self.event_queue.add_event(SendEvent.QUEUE_ADD, ret)
 
     # def add(self, url):
@@ -145,30 +268,16 @@ class QueueAudioHandler:
     def pop(self):
         if self.queue:
             self.auto_queue.clear()
-            return self.queue.pop(0)
+            return self.queue.popleft()
 
-        if not self.auto_queue:
-            self.populate_autoqueue()
-        return self.auto_queue.pop(0)
+        if self.auto_queue:
+            return self.auto_queue.popleft()
+        return None
 
     @staticmethod
     def _spawn_main_process():
         return subprocess.Popen(
-            [
-                "ffmpeg",
-                "-re",
-                "-i",
-                "-",
-                "-threads",
-                "2",
-                "-c:a",
-                "copy",
-                "-f",
-                "opus",
-                "-loglevel",
-                "error",
-                "pipe:1",
-            ],
+            _MAIN_FFMPEG_CMD,
             stdout=subprocess.PIPE,
             stdin=subprocess.PIPE,
             stderr=None,
@@ -177,27 +286,70 @@ class QueueAudioHandler:
     def oggstream_reader(self):
         pages_iter = OggStream(self.ffmpeg_stdout).iter_pages()  # type: ignore
         try:
+            header = []
             page = next(pages_iter)
             if page.flag == 2:
-                self.header += b"OggS" + page.header + page.segtable + page.data
+                header += (b"OggS", page.header, page.segtable, page.data)
 
             page = next(pages_iter)
-            self.header += b"OggS" + page.header + page.segtable + page.data
+            header += (b"OggS", page.header, page.segtable, page.data)
+            # publish both pages at once so waiters never see half a header
+            self.header = b"".join(header)
+            self.header_ready.set()
 
             for page in pages_iter:
-                partial = array("b")
-                partial.frombytes(b"OggS" + page.header + page.segtable)
-                for data, _ in page.iter_packets():
-                    partial.frombytes(data)
-
-                self.buffer = partial.tobytes()
+                # the packets of a page are laid out back to back in its body,
+                # re-joining them from iter_packets() just rebuilds page.data
+                data = b"".join((b"OggS", page.header, page.segtable, page.data))
+
+                with self.buffer_cond:
+                    self.pages.append(data)
+                    self.buffer_seq += 1
+                    self.buffer_cond.notify_all()
                 self.audio_position += 1
-                self.event.set()
-                self.event.clear()
         except ValueError:
             return
 
-    def ffmpeg_stdin_writer(self, q: Queue, sig: Event):
+    @staticmethod
+    def _track_command(track: dict) -> list[str]:
+        output = (
+            _TRACK_FFMPEG_REENCODE
+            if track.get("need_reencode", False)
+            else _TRACK_FFMPEG_COPY
+        )
+        return [*_TRACK_FFMPEG_INPUT, track["url"], *output]
+
+    def _pump(self, process: subprocess.Popen):
+        src = process.stdout
+        src_fd = src.fileno()  # type: ignore
+        dst_fd = self.ffmpeg_stdin.fileno()  # type: ignore
+        buffer = bytearray(0 if _USE_SPLICE else _PIPE_CHUNK_SIZE)
+        view = memoryview(buffer)
+
+        def move() -> int:
+            if _USE_SPLICE:
+                return os.splice(src_fd, dst_fd, _PIPE_CHUNK_SIZE)
+
+            size = src.readinto(buffer)  # type: ignore
+            self.ffmpeg_stdin.write(view[:size])  # type: ignore
+            return size
+
+        if self._skip_pipe is None:
+            while not self._skip and move():
+                pass
+            return
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(src_fd, selectors.EVENT_READ)
+            # skip() writes to this pipe, so a stalled source can't delay it
+            selector.register(self._skip_pipe[0], selectors.EVENT_READ)
+
+            while True:
+                selector.select()
+                if self._skip or not move():
+                    return
+
+    def ffmpeg_stdin_writer(self, q: Queue):
         while True:
             audio_np = q.get()
             self.audio_position = 0
@@ -206,47 +358,32 @@ class QueueAudioHandler:
             get_or_set_savefile(audio_np["webpage_url"])
 
             s = subprocess.Popen(
-                [
-                    "ffmpeg",
-                    "-reconnect",
-                    "1",
-                    "-reconnect_streamed",
-                    "1",
-                    "-reconnect_delay_max",
-                    "5",
-                    "-i",
-                    audio_np["url"],
-                    "-threads",
-                    "2",
-                    "-b:a",
-                    "152k",
-                    "-ar",
-                    "48000",
-                    "-c:a",
-                    "copy",
-                    "-f",
-                    "opus",
-                    "-vn",
-                    "-loglevel",
-                    "error",
-                    "pipe:1",
-                ],
+                self._track_command(audio_np),
+                # raw pipe, the pump reads whatever one syscall returns
+                bufsize=0,
                 stdout=subprocess.PIPE,
                 stdin=None,
                 stderr=None,
             )
 
-            while True:
-                if s.poll():
-                    break
-
-                data = s.stdout.read(8192)  # type: ignore
-                if not data or self._skip:
-                    break
-                self.ffmpeg_stdin.write(data)  # type: ignore
-
-            sig.set()
-            self._skip = False
+            self._pump(s)
+
+            # reap the track process so skipped tracks don't leave a zombie
+            # and an open pipe behind
+            if s.poll() is None:
+                s.kill()
+            s.wait()
+            s.stdout.close()  # type: ignore
+
+            with self.track_cond:
+                self._skip = False
+                if self._skip_pipe is not None:
+                    try:
+                        os.read(self._skip_pipe[0], 4096)
+                    except BlockingIOError:
+                        pass
+                self.track_done += 1
+                self.track_cond.notify_all()
             # self.header = b""
             # self.buffer = b""
             print("signal is set")
@@ -255,16 +392,23 @@ class QueueAudioHandler:
         queue = Queue()
         stdin_writer_thread = Thread(
             target=self.ffmpeg_stdin_writer,
-            args=(queue, self.next_signal),
+            args=(queue,),
             name="ffmpeg_stdin_writer",
             daemon=True,
         )
         stdin_writer_thread.start()
         print("start stdin writer")
 
+        played = 0
         while True:
-            self.next_signal.clear()
             next_track = self.pop()  # type: ignore
+            if next_track is None:
+                # nothing to play yet, wait for the related tracks or an added
+                # track, and retry the lookup now and then if it came up empty
+                self.prefetch_autoqueue()
+                self.queue_signal.wait(timeout=5)
+                self.queue_signal.clear()
+                continue
 
             try:
                 if isinstance(next_track, str):
@@ -279,20 +423,37 @@ class QueueAudioHandler:
 
             self.now_playing = next_track
             queue.put(self.now_playing)
+            # look up related tracks while this one plays, not when it ends
+            self.prefetch_autoqueue()
             print(f"Playing {self.now_playing['title']}")
             print("wait for signal")
-            self.next_signal.wait()
+            with self.track_cond:
+                self.track_cond.wait_for(lambda: self.track_done > played)
+                played = self.track_done
+
+    def wait_for_buffer(self, last_seq: int) -> tuple[int, bytes]:
+        with self.buffer_cond:
+            self.buffer_cond.wait_for(lambda: self.buffer_seq > last_seq)
+            missed = min(self.buffer_seq - last_seq, len(self.pages))
+            if missed == 1:
+                return self.buffer_seq, self.pages[-1]
+            return self.buffer_seq, b"".join(list(self.pages)[-missed:])
 
     def wait_for_header(self):
-        while True:
-            if self.header:
-                return self.header
-            sleep(0.5)
-
-    def __skip(self):
-        track = self.pop()
-        self.queue.append(track)
-        self._skip = True
+        self.header_ready.wait()
+        return self.header
 
     def skip(self):
-        run_in_thread(self.__skip, wait_for_result=False)
+        # under the lock the writer resets both, so the flag and the wake byte
+        # are always cleared together
+        with self.track_cond:
+            # one wake byte per pending skip, repeated requests add nothing
+            if self._skip:
+                return
+
+            self._skip = True
+            if self._skip_pipe is not None:
+                try:
+                    os.write(self._skip_pipe[1], b"\0")
+                except BlockingIOError:
+                    pass
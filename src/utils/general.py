@@ -1,19 +1,40 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from http.client import HTTPResponse
 import json
-from queue import Queue
 from random import randint
-from threading import Thread
 from typing import IO, Callable, Iterable, Union
 from urllib import request as urllib_request
 
 
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+
+except ImportError:
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
+
 class NonRaisingHTTPErrorProcessor(urllib_request.HTTPErrorProcessor):
     http_response = https_response = lambda self, request, response: response
 
 
+# handler chain built once, OpenerDirector.open keeps no per-request state
+_OPENER = urllib_request.build_opener(NonRaisingHTTPErrorProcessor())
+
+
 class MISSING_TYPE:
+    __slots__ = ()
+
     def __getattribute__(self, __n: str):
-        return self.__class__
+        return type(self)
 
     def __repr__(self) -> str:
         return "MISSING"
@@ -22,25 +43,42 @@ class MISSING_TYPE:
         return False
 
 
-def run_in_thread(callable: Callable, *args, wait_for_result: bool = True, **kwargs):
-    def call_func(queue: Queue):
-        ret = callable(*args, **kwargs)
-        queue.put(ret)
+# calls share a few long-lived threads instead of starting one each. unlike the
+# old daemon threads, the interpreter joins these on exit
+_WORKERS = ThreadPoolExecutor(max_workers=4, thread_name_prefix="run-in-thread")
 
-    q_ = Queue()
-    thread = Thread(
-        target=call_func, args=(q_,), name=f"run-in-thread:{id(q_):#x}", daemon=True
-    )
-    thread.start()
 
-    if not wait_for_result:
+def _report_exception(future: Future):
+    if future.cancelled():
         return
 
-    thread.join()
-    return q_.get_nowait()
+    exc = future.exception()
+    if exc is not None:
+        print(f"{exc.__class__.__name__}: {exc}")
+
+
+def run_in_thread(callable: Callable, *args, wait_for_result: bool = True, **kwargs):
+    future = _WORKERS.submit(callable, *args, **kwargs)
+    if wait_for_result:
+        return future.result()
+
+    future.add_done_callback(_report_exception)
+
+
+def shutdown_workers():
+    # drop queued calls, only the running ones are waited for on exit
+    _WORKERS.shutdown(wait=False, cancel_futures=True)
 
 
 class URLRequest:
+    # built once, urllib copies the headers into each Request it creates
+    _HEADERS_GZIP = {
+        "User-Agent": "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11",  # noqa: E501
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate, br",
+    }
+    _HEADERS_IDENTITY = {**_HEADERS_GZIP, "Accept-Encoding": "identity"}
+
     @staticmethod
     def request(
         url,
@@ -52,30 +90,21 @@ class URLRequest:
         *args,
         **kwargs,
     ) -> HTTPResponse:
-        if not headers:
-            headers = dict()
-
-        headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11",  # noqa: E501
-                "Connection": "keep-alive",
-            }
+        base_headers = (
+            __class__._HEADERS_GZIP if want_compression else __class__._HEADERS_IDENTITY
         )
-
-        if want_compression:
-            headers["Accept-Encoding"] = "gzip, deflate, br"
-        else:
-            headers["Accept-Encoding"] = "identity"
+        # the defaults still win over the caller's headers, as before, but the
+        # caller's dict is no longer modified
+        request_headers = {**headers, **base_headers} if headers else base_headers
 
         request_data = urllib_request.Request(
             url=url,
-            data=bytes(json.dumps(data), encoding="utf-8") if data else None,
-            headers=headers,
+            data=json_dumps(data) if data else None,
+            headers=request_headers,
             method=method,
         )
-        opener = urllib_request.build_opener(NonRaisingHTTPErrorProcessor())
         # try:
-        ret: HTTPResponse = opener.open(request_data, *args, **kwargs)
+        ret: HTTPResponse = _OPENER.open(request_data, *args, **kwargs)
         if ret.getcode() >= 400:
             if use_proxy:
                 return __class__.proxy_request(url, *args, **kwargs)
@@ -106,10 +135,22 @@ class URLRequest:
 class IOReading:
     @staticmethod
     def iter_contents(
-        data: Union[IO, HTTPResponse, None], chunk_size=1024
+        data: Union[IO, HTTPResponse, None], chunk_size=65536
     ) -> Iterable[bytes]:
         if not data:
             return
 
         for chunk in iter(lambda: data.read(chunk_size), b""):
             yield chunk
+
+    @staticmethod
+    def iter_into(
+        data: Union[IO, HTTPResponse, None], buffer: bytearray
+    ) -> Iterable[memoryview]:
+        # reuses the caller's buffer, each view is only valid until the next one
+        if not data:
+            return
+
+        view = memoryview(buffer)
+        while size := data.readinto(buffer):  # type: ignore
+            yield view[:size]
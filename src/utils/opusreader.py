@@ -56,7 +56,7 @@ class OggPage:
 
     def __init__(self, stream: IO[bytes]) -> None:
         try:
-            self.header = stream.read(struct.calcsize(self._header.format))
+            self.header = stream.read(self._header.size)
 
             (
                 self.flag,
@@ -68,7 +68,10 @@ class OggPage:
             ) = self._header.unpack(self.header)
 
             self.segtable: bytes = stream.read(self.segnum)
-            bodylen = sum(struct.unpack("B" * self.segnum, self.segtable))
+            if len(self.segtable) != self.segnum:
+                raise OggError("truncated segment table")
+            # iterating bytes already yields the unsigned segment lengths
+            bodylen = sum(self.segtable)
             self.data: bytes = stream.read(bodylen)
 
         except Exception: